@@ -3,7 +3,10 @@
 """
 from __future__ import annotations
 
+import asyncio
+import io
 import os
+from typing import Iterator
 
 import httpx
 import opencode_client as opencode
@@ -12,25 +15,28 @@ import opencode_runner as runner
 MAX_MESSAGE_LENGTH = 4096
 current_session_id: str | None = None
 _last_opencode_cwd: str | None = None  # 上次启动/重启 opencode 时使用的目录，/restart 时用其恢复
+_session_refresh: asyncio.Task | None = None  # /restart 后在后台选取当前 session 的任务
+_SESSION_REFRESH_WAIT = 2.0
 
 
 async def get_or_create_session() -> str:
     global current_session_id
+    task = _session_refresh
+    if task is not None and not task.done() and task.get_loop() is asyncio.get_running_loop():
+        # /restart 后的后台会话刷新尚未完成，稍等片刻以沿用其选出的会话
+        await asyncio.wait({task}, timeout=_SESSION_REFRESH_WAIT)
     if current_session_id:
-        try:
-            sessions = await opencode.list_sessions()
-            ids = [s.get("id") for s in (sessions or []) if s.get("id")]
-            if current_session_id in ids:
-                return current_session_id
-        except Exception:
-            pass
-        current_session_id = None
-    sessions = await opencode.list_sessions()
-    if not sessions:
-        session = await opencode.create_session()
-        current_session_id = session["id"]
+        sessions = await opencode.list_sessions() or []
+        if current_session_id in {s["id"] for s in sessions if s.get("id")}:
+            return current_session_id
     else:
+        # 未选定会话时只需要第一个，不必拉取完整列表
+        sessions = await opencode.list_sessions(limit=1) or []
+    if sessions:
         current_session_id = sessions[0]["id"]
+    else:
+        session = await opencode.create_session()
+        current_session_id = session["id"]
     return current_session_id
 
 
@@ -39,6 +45,11 @@ def switch_session(session_id: str) -> None:
     current_session_id = session_id
 
 
+async def close() -> None:
+    """退出前关闭与 OpenCode 的共享 HTTP 连接。"""
+    await opencode.aclose()
+
+
 def set_last_opencode_cwd(cwd: str) -> None:
     """记录上次启动 opencode 的目录，供 /restart 使用。"""
     global _last_opencode_cwd
@@ -48,18 +59,17 @@ def set_last_opencode_cwd(cwd: str) -> None:
 def strip_leading_for_command(s: str) -> str:
     """去掉首位的空格与不可见字符，用于判断首个可见字符是否为 /。"""
     s = (s or "").lstrip()
-    while s and not s[0].isprintable():
-        s = s[1:]
-    return s
+    i, n = 0, len(s)
+    while i < n and not s[i].isprintable():
+        i += 1
+    return s[i:]
 
 
-def chunk_text(text: str, size: int = MAX_MESSAGE_LENGTH) -> list[str]:
+def chunk_text(text: str, size: int = MAX_MESSAGE_LENGTH) -> Iterator[str]:
+    """按 size 切分文本，逐段惰性产出（发送方边切边发）。"""
     if len(text) <= size:
-        return [text] if text else []
-    out = []
-    for i in range(0, len(text), size):
-        out.append(text[i : i + size])
-    return out
+        return iter([text] if text else [])
+    return (text[i : i + size] for i in range(0, len(text), size))
 
 
 async def get_sessions() -> list[dict]:
@@ -68,18 +78,17 @@ async def get_sessions() -> list[dict]:
 
 def _format_session_messages(messages: list) -> str:
     """将 session 消息列表格式化为 Markdown（用于导出 .md 文件）。"""
-    blocks = []
+    buf = io.StringIO()
     for i, msg in enumerate(messages or []):
-        parts = msg.get("parts") or []
-        blocks.append(f"## Message {i + 1}\n")
-        for p in parts:
-            if p.get("type") == "text" and "text" in p:
-                text = (p.get("text") or "").strip()
-                if text:
-                    blocks.append(text)
-                    blocks.append("")
-        blocks.append("")
-    return "\n".join(blocks).strip() or "(无内容)"
+        buf.write(f"## Message {i + 1}\n\n")
+        for p in msg.get("parts") or []:
+            if p.get("type") == "text":
+                text = p.get("text")
+                if text and (text := text.strip()):
+                    buf.write(text)
+                    buf.write("\n\n")
+        buf.write("\n")
+    return buf.getvalue().rstrip() or "(无内容)"
 
 
 async def handle_export_session() -> tuple[bytes | None, str]:
@@ -120,13 +129,16 @@ async def handle_session_list() -> str:
     return "会话列表（点击下方按钮切换当前会话）:\n" + "\n".join(lines)
 
 
+# /newproj 子目录名中禁止的字符：路径分隔符与 ASCII 控制字符，translate 时删除
+_PROJ_SUBDIR_BAD_CHARS = str.maketrans("", "", "/\\" + "".join(chr(i) for i in range(32)))
+
+
 def _validate_proj_subdir(name: str) -> str | None:
     """校验 /newproj xxxx 的 xxxx：仅允许可见字符、无路径成分。返回错误说明或 None 表示通过。"""
     if not name or len(name) > 64:
         return "子目录名长度须 1～64"
-    for c in name:
-        if c in "/\\\0\t\n\r" or ord(c) < 32:
-            return "子目录名不可含不可见字符或路径符号"
+    if len(name.translate(_PROJ_SUBDIR_BAD_CHARS)) != len(name):
+        return "子目录名不可含不可见字符或路径符号"
     if name.startswith(".") or ".." in name:
         return "子目录名不可含 .. 或以 . 开头"
     return None
@@ -159,7 +171,8 @@ async def handle_new_project(
         cwd = os.path.expanduser("~/bots/" + subdir.strip())
     else:
         cwd = runner._default_cwd()
-    ok, msg = runner.restart_opencode(log_path=log_path, cwd=cwd)
+    ok, msg = await runner.restart_opencode(log_path=log_path, cwd=cwd)
+    opencode.invalidate_sessions_cache()
     if not ok:
         return f"重启 OpenCode 失败: {msg}"
     _last_opencode_cwd = cwd
@@ -172,13 +185,15 @@ async def handle_new_project(
         return f"创建会话失败: {e}"
 
 
-def handle_opencode_status() -> str:
+async def handle_opencode_status() -> str:
     base = runner.get_base_url()
     port = runner._parse_port_from_base_url(base)
     if port in (80, 443):
         port = runner.DEFAULT_PORT
-    in_use, pid, cmd = runner.check_port(port)
-    healthy = runner.is_opencode_healthy()
+    (in_use, pid, cmd), healthy = await asyncio.gather(
+        runner.check_port(port),
+        runner.is_opencode_healthy(),
+    )
     lines = [
         f"端口: {port}",
         f"占用: {'是' if in_use else '否'}",
@@ -191,37 +206,43 @@ def handle_opencode_status() -> str:
     return "OpenCode 状态:\n" + "\n".join(lines)
 
 
-def is_opencode_healthy() -> bool:
-    return runner.is_opencode_healthy()
+async def is_opencode_healthy() -> bool:
+    return await runner.is_opencode_healthy()
 
 
-def handle_start_opencode(log_path: str) -> tuple[bool, str]:
+async def handle_start_opencode(log_path: str) -> tuple[bool, str]:
     global _last_opencode_cwd
-    ok, msg = runner.ensure_opencode_running(log_path=log_path)
+    ok, msg = await runner.ensure_opencode_running(log_path=log_path)
+    opencode.invalidate_sessions_cache()
     if ok and _last_opencode_cwd is None:
         _last_opencode_cwd = runner._default_cwd()
     return ok, msg
 
 
+async def _refresh_current_session_after_restart() -> None:
+    """重启后在后台取会话列表，把当前 session 设为最近的一个（期间若已选定会话则不覆盖）。"""
+    try:
+        sessions = await opencode.list_sessions()
+        if not sessions or current_session_id is not None:
+            return
+        # Session.time 为 {created, updated}，按最近更新时间选取
+        latest = max(sessions, key=lambda s: (s.get("time") or {}).get("updated") or 0)
+        switch_session(latest.get("id"))
+    except Exception:
+        pass
+
+
 async def handle_restart_opencode(log_path: str) -> tuple[bool, str]:
-    """用上次的目录重启 OpenCode，并将当前 session 设为该目录下最近的一个。"""
-    global current_session_id, _last_opencode_cwd
+    """用上次的目录重启 OpenCode，并在后台将当前 session 设为该目录下最近的一个。"""
+    global current_session_id, _last_opencode_cwd, _session_refresh
     cwd = _last_opencode_cwd or runner._default_cwd()
     _last_opencode_cwd = cwd
-    ok, msg = runner.restart_opencode(log_path=log_path, cwd=cwd)
+    ok, msg = await runner.restart_opencode(log_path=log_path, cwd=cwd)
+    opencode.invalidate_sessions_cache()
     if not ok:
         return ok, msg
     current_session_id = None
-    try:
-        sessions = await opencode.list_sessions()
-        if sessions:
-            def sort_key(s: dict) -> tuple:
-                t = s.get("time") or ""
-                return (1 if t else 0, t)
-            sessions = sorted(sessions, key=sort_key, reverse=True)
-            current_session_id = sessions[0].get("id")
-    except Exception:
-        pass
+    _session_refresh = asyncio.create_task(_refresh_current_session_after_restart())
     return ok, msg
 
 
@@ -239,6 +260,15 @@ async def handle_switch_session(session_id: str) -> str:
         return f"切换失败: {e}"
 
 
+def _reply_text(result: str) -> str:
+    if result == opencode.MERGED_REPLY:
+        # 已与同一会话中随后的消息合并发送，回复随最后一条给出；返回空串，调用方不发送
+        return ""
+    if not result:
+        return "(无文本结果)"
+    return result
+
+
 async def handle_message(text: str) -> str:
     try:
         session_id = await get_or_create_session()
@@ -249,17 +279,14 @@ async def handle_message(text: str) -> str:
         if e.response.status_code == 404:
             global current_session_id
             current_session_id = None
+            opencode.invalidate_sessions_cache()
             try:
                 session_id = await get_or_create_session()
                 result = await opencode.send_message(session_id, text)
             except Exception as retry_e:
                 return f"调用 OpenCode 失败: {retry_e}"
-            if not result:
-                return "(无文本结果)"
-            return result
+            return _reply_text(result)
         return f"调用 OpenCode 失败: {e}"
     except Exception as e:
         return f"调用 OpenCode 失败: {e}"
-    if not result:
-        return "(无文本结果)"
-    return result
+    return _reply_text(result)
@@ -24,7 +24,7 @@ def main() -> None:
 
     config = load_config()
     root = os.path.dirname(os.path.abspath(__file__))
-    ok, msg = runner.ensure_opencode_running(log_path=os.path.join(root, "opencode.log"))
+    ok, msg = runner.ensure_opencode_running_sync(log_path=os.path.join(root, "opencode.log"))
     if ok:
         bot_core.set_last_opencode_cwd(runner._default_cwd())
     logger.info("OpenCode: %s", msg)
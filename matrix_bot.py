@@ -174,10 +174,10 @@ async def _run_matrix(
                 await send_text(room.room_id, f"OpenCode: {msg}")
                 return
             if body_for_cmd == "/opencode":
-                text = bot_core.handle_opencode_status()
-                if not bot_core.is_opencode_healthy():
+                text = await bot_core.handle_opencode_status()
+                if not await bot_core.is_opencode_healthy():
                     log_path = os.path.join(ROOT, "opencode.log")
-                    ok, msg = bot_core.handle_start_opencode(log_path)
+                    ok, msg = await bot_core.handle_start_opencode(log_path)
                     text = f"OpenCode: {msg}"
                 await send_text(room.room_id, text)
                 return
@@ -302,6 +302,7 @@ async def _run_matrix(
                 await asyncio.sleep(5)
     finally:
         await client.close()
+        await bot_core.close()
 
 
 async def main_async() -> None:
@@ -9,28 +9,59 @@ import asyncio
 import json
 import os
 import time
+import weakref
 from typing import Optional, Tuple
 
 import httpx
 
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时退回标准库 json
+    orjson = None
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+# 每个事件循环一个长连接客户端（Telegram 与 Matrix 可能跑在不同线程的事件循环里），
+# 复用 keep-alive 连接，避免每次请求重新建连；https 下经 ALPN 协商 HTTP/2，轮询 GET 与 prompt 可多路复用同一连接。
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+    weakref.WeakKeyDictionary()
+)
+# reload_config() 换下、但其事件循环当时未在运行的旧客户端，待该循环下次调用 _get_client / aclose 时关闭
+_retired_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, list[httpx.AsyncClient]]" = (
+    weakref.WeakKeyDictionary()
+)
+_closing_tasks: set[asyncio.Task] = set()
+
+# GET /session 缓存：base_url -> (获取时间, 会话列表)。
+_SESSIONS_TTL = 2.0
+_SESSIONS_MAX_STALE = 30.0
+_sessions_cache: dict[str, tuple[float, list]] = {}
+_sessions_refreshing: dict[str, asyncio.Task] = {}
+_sessions_generation = 0
+
 
 def _parse_json(r: httpx.Response) -> dict | list:
     """解析响应为 JSON，若为空或非 JSON 则抛出带状态码和内容预览的异常。"""
-    text = (r.text or "").strip()
-    if not text:
+    raw = r.content.strip()
+    if not raw:
         raise ValueError(
-            f"OpenCode 返回空内容 (HTTP {r.status_code})，请确认服务已启动且地址正确: {_get_base_url()}"
+            f"OpenCode 返回空内容 (HTTP {r.status_code})，请确认服务已启动且地址正确: {_BASE_URL}"
         )
     try:
-        return json.loads(text)
-    except json.JSONDecodeError as e:
-        preview = text[:200].replace("\n", " ")
+        return _json_loads(raw)
+    except ValueError as e:  # JSONDecodeError，或标准库 json 遇到非法 UTF-8 时的 UnicodeDecodeError
+        preview = raw[:200].decode("utf-8", "replace").replace("\n", " ")
         raise ValueError(
             f"OpenCode 返回非 JSON (HTTP {r.status_code})，内容预览: {preview}。错误: {e}"
         ) from e
 
 DEFAULT_BASE_URL = "http://127.0.0.1:4096"
 
+# prompt_async 轮询间隔：从 _POLL_INITIAL_DELAY 起按 _POLL_BACKOFF 倍增长，上限 _POLL_MAX_DELAY（秒）
+_POLL_INITIAL_DELAY = 0.2
+_POLL_BACKOFF = 1.6
+_POLL_MAX_DELAY = 3.0
+
 
 def _message_timeout() -> float:
     """可配置：环境变量 OPENCODE_MESSAGE_TIMEOUT（秒），默认 600（10 分钟）。"""
@@ -51,8 +82,79 @@ def _auth() -> Optional[Tuple[str, str]]:
     return (user, password)
 
 
-def _get_base_url() -> str:
-    return os.environ.get("OPENCODE_BASE_URL", DEFAULT_BASE_URL)
+def _env_flag(name: str) -> bool:
+    return os.environ.get(name, "").strip() in ("1", "true", "yes")
+
+
+# 环境变量在导入时解析一次；修改环境变量后调用 reload_config()。
+_BASE_URL = DEFAULT_BASE_URL
+_AUTH: Optional[Tuple[str, str]] = None
+_MSG_TIMEOUT = 600.0
+
+
+def reload_config() -> None:
+    """重新读取 OPENCODE_* 环境变量，并丢弃按旧配置创建的客户端与会话缓存。"""
+    global _BASE_URL, _AUTH, _MSG_TIMEOUT, _prompt, send_message
+    _BASE_URL = os.environ.get("OPENCODE_BASE_URL", DEFAULT_BASE_URL)
+    _AUTH = _auth()
+    _MSG_TIMEOUT = _message_timeout()
+    _prompt = _prompt_async_poll if _env_flag("OPENCODE_USE_ASYNC") else _prompt_direct
+    send_message = (
+        _send_message_batched if _env_flag("OPENCODE_BATCH_SENDS") else _send_message_now
+    )
+    _retire_clients()
+    invalidate_sessions_cache()
+
+
+def _retire_clients() -> None:
+    """把按旧配置创建的客户端交给各自的事件循环关闭，而不是直接丢弃。"""
+    try:
+        current = asyncio.get_running_loop()
+    except RuntimeError:
+        current = None
+    for loop, client in list(_clients.items()):
+        if loop is current:
+            task = loop.create_task(client.aclose())
+            _closing_tasks.add(task)
+            task.add_done_callback(_closing_tasks.discard)
+        elif loop.is_running():
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+        elif not loop.is_closed():
+            _retired_clients.setdefault(loop, []).append(client)
+    _clients.clear()
+
+
+async def _close_retired_clients() -> None:
+    for client in _retired_clients.pop(asyncio.get_running_loop(), []):
+        await client.aclose()
+
+
+def _get_client() -> httpx.AsyncClient:
+    """返回当前事件循环的共享 AsyncClient，首次调用时创建。"""
+    loop = asyncio.get_running_loop()
+    if loop in _retired_clients:
+        task = loop.create_task(_close_retired_clients())
+        _closing_tasks.add(task)
+        task.add_done_callback(_closing_tasks.discard)
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            base_url=_BASE_URL,
+            auth=_AUTH,
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+            http2=True,
+        )
+        _clients[loop] = client
+    return client
+
+
+async def aclose() -> None:
+    """关闭当前事件循环的共享 AsyncClient，供退出时调用。"""
+    await _close_retired_clients()
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
 
 
 def _extract_final_result(data: dict) -> str:
@@ -64,44 +166,87 @@ def _extract_final_result(data: dict) -> str:
     return text_parts[-1].strip()
 
 
-async def health() -> dict:
+async def health(timeout: float = 10.0) -> dict:
     """GET /global/health"""
-    async with httpx.AsyncClient(
-        base_url=_get_base_url(), auth=_auth(), timeout=10.0
-    ) as client:
-        r = await client.get("/global/health")
-        r.raise_for_status()
-        return _parse_json(r)
+    client = _get_client()
+    r = await client.get("/global/health", timeout=timeout)
+    r.raise_for_status()
+    return _parse_json(r)
+
+
+async def _fetch_sessions(limit: Optional[int] = None) -> list:
+    client = _get_client()
+    r = await client.get("/session", params={"limit": limit} if limit is not None else None)
+    r.raise_for_status()
+    return _parse_json(r)
+
+
+async def _refresh_sessions(key: str, generation: int) -> None:
+    """后台刷新会话列表缓存；期间若缓存被作废则丢弃结果。"""
+    try:
+        sessions = await _fetch_sessions()
+        if generation == _sessions_generation:
+            _sessions_cache[key] = (time.monotonic(), sessions)
+    except Exception:
+        pass
+    finally:
+        _sessions_refreshing.pop(key, None)
+
 
+def invalidate_sessions_cache() -> None:
+    """作废会话列表缓存（新建会话、重启 OpenCode 后调用）。"""
+    global _sessions_generation
+    _sessions_generation += 1
+    _sessions_cache.clear()
 
-async def list_sessions() -> list:
-    """GET /session"""
-    async with httpx.AsyncClient(
-        base_url=_get_base_url(), auth=_auth(), timeout=10.0
-    ) as client:
-        r = await client.get("/session")
-        r.raise_for_status()
-        return _parse_json(r)
+
+async def list_sessions(limit: Optional[int] = None) -> list:
+    """
+    GET /session，结果按 base_url 缓存 _SESSIONS_TTL 秒。
+    过期但未超过 _SESSIONS_MAX_STALE 时先返回旧值，并在后台刷新。
+    传 limit 时只取前 limit 个（服务端忽略该参数时在本地截断），结果不写入缓存。
+    """
+    key = _BASE_URL
+    cached = _sessions_cache.get(key)
+    if limit is not None:
+        if cached is not None and time.monotonic() - cached[0] < _SESSIONS_TTL:
+            return cached[1][:limit]
+        return (await _fetch_sessions(limit))[:limit]
+    if cached is not None:
+        ts, sessions = cached
+        age = time.monotonic() - ts
+        if age < _SESSIONS_TTL:
+            return sessions
+        if age < _SESSIONS_MAX_STALE:
+            if key not in _sessions_refreshing:
+                _sessions_refreshing[key] = asyncio.create_task(
+                    _refresh_sessions(key, _sessions_generation)
+                )
+            return sessions
+    generation = _sessions_generation
+    sessions = await _fetch_sessions()
+    if generation == _sessions_generation:
+        _sessions_cache[key] = (time.monotonic(), sessions)
+    return sessions
 
 
 async def create_session(title: Optional[str] = None) -> dict:
     """POST /session"""
-    async with httpx.AsyncClient(
-        base_url=_get_base_url(), auth=_auth(), timeout=10.0
-    ) as client:
-        r = await client.post("/session", json={"title": title} if title else {})
-        r.raise_for_status()
-        return _parse_json(r)
+    client = _get_client()
+    r = await client.post("/session", json={"title": title} if title else {})
+    r.raise_for_status()
+    invalidate_sessions_cache()
+    return _parse_json(r)
 
 
 async def _get_messages(session_id: str, limit: int = 5) -> list:
     """GET /session/:id/message?limit=N"""
-    async with httpx.AsyncClient(
-        base_url=_get_base_url(), auth=_auth(), timeout=15.0
-    ) as client:
-        r = await client.get(f"/session/{session_id}/message", params={"limit": limit})
-        r.raise_for_status()
-        return _parse_json(r)
+    client = _get_client()
+    r = await client.get(
+        f"/session/{session_id}/message", params={"limit": limit}, timeout=15.0
+    )
+    r.raise_for_status()
+    return _parse_json(r)
 
 
 async def get_session_messages(session_id: str, limit: int = 500) -> list:
@@ -109,49 +254,147 @@ async def get_session_messages(session_id: str, limit: int = 500) -> list:
     return await _get_messages(session_id, limit=limit)
 
 
-async def send_message_async_poll(session_id: str, text: str) -> str:
-    """
-    POST /session/:id/prompt_async 提交后轮询 GET message，避免单次长连接超时。
-    总等待时间受 OPENCODE_MESSAGE_TIMEOUT 限制，轮询间隔 3 秒。
-    """
-    timeout = _message_timeout()
-    async with httpx.AsyncClient(
-        base_url=_get_base_url(), auth=_auth(), timeout=15.0
-    ) as client:
-        r = await client.post(
-            f"/session/{session_id}/prompt_async",
-            json={"parts": [{"type": "text", "text": text}]},
-        )
-        r.raise_for_status()
-    n_before = len(await _get_messages(session_id, limit=10))
+def _text_parts(texts: list[str]) -> list[dict]:
+    return [{"type": "text", "text": t} for t in texts]
+
+
+def _last_message_key(messages: list) -> tuple:
+    """最后一条消息的标识（id，无 id 时退化为条数），用于判断是否有新消息。"""
+    if not messages:
+        return (0, None)
+    return (len(messages), (messages[-1].get("info") or {}).get("id"))
+
+
+async def _prompt_async_poll(session_id: str, parts: list[dict]) -> str:
+    timeout = _MSG_TIMEOUT
+    client = _get_client()
+    # 在提交前记录最后一条消息：OpenCode 接受 prompt 后几乎立即创建助手消息，
+    # 提交后再记录会把这条未完成的回复当成“旧消息”而一直跳过
+    last_before = _last_message_key(await _get_messages(session_id, limit=10))
+    r = await client.post(
+        f"/session/{session_id}/prompt_async",
+        json={"parts": parts},
+        timeout=15.0,
+    )
+    r.raise_for_status()
     deadline = time.monotonic() + timeout
+    delay = _POLL_INITIAL_DELAY
     while time.monotonic() < deadline:
-        await asyncio.sleep(3)
+        await asyncio.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+        delay = min(_POLL_MAX_DELAY, delay * _POLL_BACKOFF)
         messages = await _get_messages(session_id, limit=10)
-        if len(messages) > n_before:
-            last = messages[-1]
-            result = _extract_final_result(last)
-            if result:
-                return result
+        if not messages or _last_message_key(messages) == last_before:
+            continue
+        last = messages[-1]
+        info = last.get("info") or {}
+        if info.get("role") == "user":
+            continue
+        t = info.get("time")
+        if isinstance(t, dict) and not t.get("completed"):
+            continue  # 助手消息仍在生成中
+        result = _extract_final_result(last)
+        if result:
+            return result
     raise httpx.TimeoutException("轮询等待结果超时")
 
 
-async def send_message(session_id: str, text: str) -> str:
+async def _prompt_direct(session_id: str, parts: list[dict]) -> str:
+    client = _get_client()
+    r = await client.post(
+        f"/session/{session_id}/message",
+        json={"parts": parts},
+        timeout=httpx.Timeout(_MSG_TIMEOUT, connect=5.0),
+    )
+    r.raise_for_status()
+    data = _parse_json(r)
+    return _extract_final_result(data)
+
+
+# 合并发送时，批内除最后一条外的消息得到此标记：其回复已并入最后一条消息的回复
+MERGED_REPLY = "\x00merged"
+
+
+class _SessionSendQueue:
     """
-    POST /session/:id/message，只返回解析出的最终结果（最后一条 text part）。
-    若 OPENCODE_USE_ASYNC=1 则改用 prompt_async + 轮询，适合长任务。
-    长任务可能超时；可设置 OPENCODE_MESSAGE_TIMEOUT（秒）增大超时。
+    同一 session 的消息发送队列：单个 worker 依次发送，
+    上一次请求进行期间到达的消息合并为一次请求（多个 text part）。
+    合并后的回复只交给批内最后一条消息的发送方，其余发送方得到 MERGED_REPLY。
     """
-    if os.environ.get("OPENCODE_USE_ASYNC", "").strip() in ("1", "true", "yes"):
-        return await send_message_async_poll(session_id, text)
-    timeout = _message_timeout()
-    async with httpx.AsyncClient(
-        base_url=_get_base_url(), auth=_auth(), timeout=timeout
-    ) as client:
-        r = await client.post(
-            f"/session/{session_id}/message",
-            json={"parts": [{"type": "text", "text": text}]},
-        )
-        r.raise_for_status()
-        data = _parse_json(r)
-        return _extract_final_result(data)
+
+    def __init__(self, session_id: str) -> None:
+        self.session_id = session_id
+        self._pending: asyncio.Queue[tuple[str, asyncio.Future]] = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, text: str) -> str:
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.put_nowait((text, fut))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return await fut
+
+    async def _run(self) -> None:
+        try:
+            while not self._pending.empty():
+                # 让出一轮事件循环，使同一时刻到达的消息一并入队
+                await asyncio.sleep(0)
+                batch = []
+                while not self._pending.empty():
+                    batch.append(self._pending.get_nowait())
+                try:
+                    result = await _prompt(self.session_id, _text_parts([t for t, _ in batch]))
+                except Exception as e:
+                    for _, fut in batch:
+                        if not fut.done():
+                            fut.set_exception(e)
+                else:
+                    for i, (_, fut) in enumerate(batch, 1):
+                        if not fut.done():
+                            fut.set_result(result if i == len(batch) else MERGED_REPLY)
+        finally:
+            queues = _send_queues.get(asyncio.get_running_loop())
+            if queues is not None and self._pending.empty():
+                queues.pop(self.session_id, None)
+
+
+_send_queues: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, _SessionSendQueue]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _get_send_queue(session_id: str) -> _SessionSendQueue:
+    queues = _send_queues.setdefault(asyncio.get_running_loop(), {})
+    q = queues.get(session_id)
+    if q is None:
+        q = queues[session_id] = _SessionSendQueue(session_id)
+    return q
+
+
+async def send_message_async_poll(session_id: str, text: str) -> str:
+    """
+    POST /session/:id/prompt_async 提交后轮询 GET message，避免单次长连接超时。
+    总等待时间受 OPENCODE_MESSAGE_TIMEOUT 限制，轮询间隔从 0.2 秒指数增长到 3 秒。
+    """
+    return await _prompt_async_poll(session_id, _text_parts([text]))
+
+
+async def _send_message_now(session_id: str, text: str) -> str:
+    return await _prompt(session_id, _text_parts([text]))
+
+
+async def _send_message_batched(session_id: str, text: str) -> str:
+    return await _get_send_queue(session_id).submit(text)
+
+
+# send_message(session_id, text) -> str
+# POST /session/:id/message，只返回解析出的最终结果（最后一条 text part）。
+# 若 OPENCODE_USE_ASYNC=1 则改用 prompt_async + 轮询，适合长任务。
+# 若 OPENCODE_BATCH_SENDS=1 则同一 session 的并发消息合并为一次请求，
+# 回复只返回给最后一条，其余返回 MERGED_REPLY。
+# 长任务可能超时；可设置 OPENCODE_MESSAGE_TIMEOUT（秒）增大超时。
+# 具体实现与 _prompt 一样由 reload_config() 按环境变量绑定，发送时不再判断。
+send_message = _send_message_now
+_prompt = _prompt_direct
+
+
+reload_config()
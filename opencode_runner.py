@@ -3,24 +3,43 @@
 """
 from __future__ import annotations
 
+import asyncio
+import functools
 import os
+import re
 import socket
 import subprocess
-import time
 from datetime import date
 from typing import Optional
 
-import httpx
+import opencode_client
 
 DEFAULT_PORT = 4096
 DEFAULT_HOST = "127.0.0.1"
 OPENCODE_SERVE_CMD = ["opencode", "serve"]
+_PID_RE = re.compile(r"pid=(\d+)")
+# 端口探测地址只解析一次，避免每次 connect 都走 getaddrinfo
+_LOCALHOST_ADDRINFO = socket.getaddrinfo(DEFAULT_HOST, 0, socket.AF_INET, socket.SOCK_STREAM)[0]
+
+
+# 环境变量在导入时解析一次；修改环境变量后调用 reload_config()。
+_BASE_URL = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}"
+
+
+def reload_config() -> None:
+    """重新读取 OPENCODE_BASE_URL 环境变量。"""
+    global _BASE_URL
+    _BASE_URL = os.environ.get("OPENCODE_BASE_URL", f"http://{DEFAULT_HOST}:{DEFAULT_PORT}")
+
+
+reload_config()
 
 
 def get_base_url() -> str:
-    return os.environ.get("OPENCODE_BASE_URL", f"http://{DEFAULT_HOST}:{DEFAULT_PORT}")
+    return _BASE_URL
 
 
+@functools.lru_cache(maxsize=8)
 def _parse_port_from_base_url(url: str) -> int:
     try:
         if url.startswith("http://"):
@@ -37,75 +56,85 @@ def _parse_port_from_base_url(url: str) -> int:
         return DEFAULT_PORT
 
 
-def check_port(port: int) -> tuple[bool, Optional[int], Optional[str]]:
+async def check_port(port: int) -> tuple[bool, Optional[int], Optional[str]]:
     """
     检查端口是否被占用。返回 (是否占用, pid 或 None, 进程简述或 None)。
     """
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(1)
-            s.connect((DEFAULT_HOST, port))
-    except (socket.error, OSError):
+    if not await asyncio.to_thread(_port_accepts, port):
         return False, None, None
-    pid, cmd = _get_process_on_port(port)
+    pid, cmd = await _get_process_on_port(port)
     return True, pid, cmd
 
 
-def _get_process_on_port(port: int) -> tuple[Optional[int], Optional[str]]:
-    """Linux: 用 lsof 或 ss 获取占用端口的进程 pid 与简要命令。"""
-    pid = None
-    for prog in (["lsof", "-i", f":{port}", "-t"], ["fuser", f"{port}/tcp"]):
-        try:
-            out = subprocess.run(prog, capture_output=True, text=True, timeout=2)
-            if out.returncode == 0 and (out.stdout or out.stderr or "").strip():
-                raw = (out.stdout or out.stderr).strip().split()
-                if raw:
-                    pid = int(raw[0])
-                    break
-        except (FileNotFoundError, subprocess.TimeoutExpired, ValueError):
-            continue
-    if pid is None:
-        try:
-            out = subprocess.run(
-                ["ss", "-tlnp"], capture_output=True, text=True, timeout=2
-            )
-            if out.returncode == 0:
-                import re
-                for line in out.stdout.splitlines():
-                    if f":{port}" in line and "pid=" in line:
-                        m = re.search(r"pid=(\d+)", line)
-                        if m:
-                            pid = int(m.group(1))
-                            break
-        except (FileNotFoundError, subprocess.TimeoutExpired):
-            pass
-    cmd = None
-    if pid:
+def _port_accepts(port: int) -> bool:
+    family, type_, proto, _, sockaddr = _LOCALHOST_ADDRINFO
+    try:
+        with socket.socket(family, type_, proto) as s:
+            s.settimeout(0.2)  # 本机 connect，正常远低于 1ms
+            return s.connect_ex((sockaddr[0], port)) == 0
+    except OSError:
+        return False
+
+
+def _find_pid_on_port(port: int) -> Optional[int]:
+    """Linux: 用一次 ss -tlnpH 找监听该端口的进程 pid；ss 不可用或失败时退回 lsof。"""
+    try:
+        out = subprocess.run(
+            ["ss", "-tlnpH"], capture_output=True, text=True, timeout=1
+        )
+    except (FileNotFoundError, subprocess.TimeoutExpired):
+        out = None
+    if out is not None and out.returncode == 0:
+        needle = f":{port} "
+        for line in out.stdout.splitlines():
+            if needle in line:
+                m = _PID_RE.search(line)
+                if m:
+                    return int(m.group(1))
+        return None
+    try:
+        # 只匹配监听套接字，否则会连带列出本进程连到该端口的 keep-alive 连接
+        out = subprocess.run(
+            ["lsof", "-nP", f"-iTCP:{port}", "-sTCP:LISTEN", "-t"],
+            capture_output=True,
+            text=True,
+            timeout=2,
+        )
+        if out.returncode == 0:
+            raw = out.stdout.split()
+            if raw:
+                return int(raw[0])
+    except (FileNotFoundError, subprocess.TimeoutExpired, ValueError):
+        pass
+    return None
+
+
+def _read_cmdline(pid: int) -> Optional[str]:
+    try:
+        fd = os.open(f"/proc/{pid}/cmdline", os.O_RDONLY)
         try:
-            with open(f"/proc/{pid}/cmdline") as f:
-                cmd = f.read().replace("\0", " ").strip()[:80]
-        except Exception:
-            pass
+            raw = os.read(fd, 4096)
+        finally:
+            os.close(fd)
+    except OSError:
+        return None
+    return raw.decode(errors="replace").replace("\0", " ").strip()[:80]
+
+
+async def _get_process_on_port(port: int) -> tuple[Optional[int], Optional[str]]:
+    """获取占用端口的进程 pid 与简要命令。"""
+    pid = await asyncio.to_thread(_find_pid_on_port, port)
+    cmd = _read_cmdline(pid) if pid else None
     return pid, cmd
 
 
-def is_opencode_healthy() -> bool:
-    """请求 /global/health，判断 OpenCode 是否可用。"""
-    base = get_base_url()
-    auth = None
-    if os.environ.get("OPENCODE_SERVER_PASSWORD"):
-        auth = (
-            os.environ.get("OPENCODE_SERVER_USERNAME", "opencode"),
-            os.environ.get("OPENCODE_SERVER_PASSWORD"),
-        )
+async def is_opencode_healthy() -> bool:
+    """请求 /global/health（复用 opencode_client 的共享连接），判断 OpenCode 是否可用。"""
     try:
-        r = httpx.get(f"{base.rstrip('/')}/global/health", auth=auth, timeout=3)
-        if r.status_code == 200:
-            data = r.json()
-            return data.get("healthy") is True
+        data = await opencode_client.health(timeout=3.0)
+        return data.get("healthy") is True
     except Exception:
-        pass
-    return False
+        return False
 
 
 def _default_cwd() -> str:
@@ -160,20 +189,20 @@ def start_opencode(
     return True, f"已启动 opencode serve (pid={p.pid}, {hostname}:{port}, cwd={work_dir})"
 
 
-def _kill_port_process(port: int) -> bool:
+async def _kill_port_process(port: int) -> bool:
     """终止占用端口的进程。返回是否成功终止。"""
-    in_use, pid, _ = check_port(port)
+    in_use, pid, _ = await check_port(port)
     if not in_use or not pid:
         return True
     try:
         os.kill(pid, 15)
         for _ in range(10):
-            time.sleep(0.5)
-            in_use2, _, _ = check_port(port)
+            await asyncio.sleep(0.5)
+            in_use2, _, _ = await check_port(port)
             if not in_use2:
                 return True
         os.kill(pid, 9)
-        time.sleep(0.5)
+        await asyncio.sleep(0.5)
         return True
     except ProcessLookupError:
         return True
@@ -181,7 +210,20 @@ def _kill_port_process(port: int) -> bool:
         return False
 
 
-def restart_opencode(
+async def _wait_healthy(total: float) -> bool:
+    """启动后轮询健康检查，间隔从 0.1 秒按 1.5 倍增长至 1 秒，最多等待 total 秒。"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + total
+    delay = 0.1
+    while loop.time() < deadline:
+        await asyncio.sleep(delay)
+        delay = min(1.0, delay * 1.5)
+        if await is_opencode_healthy():
+            return True
+    return False
+
+
+async def restart_opencode(
     port: Optional[int] = None,
     log_path: Optional[str] = None,
     cwd: Optional[str] = None,
@@ -193,20 +235,18 @@ def restart_opencode(
     port = port or _parse_port_from_base_url(get_base_url())
     if port == 80:
         port = DEFAULT_PORT
-    if not _kill_port_process(port):
+    if not await _kill_port_process(port):
         return False, f"无法终止端口 {port} 上的进程"
-    time.sleep(1)
+    await asyncio.sleep(1)
     ok, msg = start_opencode(port=port, log_path=log_path, cwd=cwd)
     if not ok:
         return False, msg
-    for _ in range(15):
-        time.sleep(1)
-        if is_opencode_healthy():
-            return True, f"已重启 OpenCode: {msg}"
+    if await _wait_healthy(15.0):
+        return True, f"已重启 OpenCode: {msg}"
     return False, f"已启动但健康检查未通过: {msg}"
 
 
-def ensure_opencode_running(
+async def ensure_opencode_running(
     port: Optional[int] = None,
     log_path: Optional[str] = None,
     cwd: Optional[str] = None,
@@ -215,21 +255,35 @@ def ensure_opencode_running(
     若 OpenCode 未健康则尝试启动。返回 (是否可用, 说明)。
     cwd 未传时使用 _default_cwd()。
     """
-    if is_opencode_healthy():
+    if await is_opencode_healthy():
         return True, "OpenCode 已在运行"
     port = port or _parse_port_from_base_url(get_base_url())
     if port == 80:
         port = DEFAULT_PORT
-    in_use, pid, cmd = check_port(port)
-    if in_use and not is_opencode_healthy():
+    in_use, pid, cmd = await check_port(port)
+    if in_use and not await is_opencode_healthy():
         return False, f"端口 {port} 已被占用 (pid={pid}, {cmd or '?'})，但非 OpenCode"
     if in_use:
         return True, "OpenCode 已在运行"
     ok, msg = start_opencode(port=port, log_path=log_path, cwd=cwd)
     if not ok:
         return False, msg
-    for _ in range(10):
-        time.sleep(1)
-        if is_opencode_healthy():
-            return True, msg
+    if await _wait_healthy(10.0):
+        return True, msg
     return False, "已启动但健康检查未通过，请稍后重试"
+
+
+def ensure_opencode_running_sync(
+    port: Optional[int] = None,
+    log_path: Optional[str] = None,
+    cwd: Optional[str] = None,
+) -> tuple[bool, str]:
+    """ensure_opencode_running 的同步版本，供事件循环启动前（main / run_telegram）调用。"""
+
+    async def run() -> tuple[bool, str]:
+        try:
+            return await ensure_opencode_running(port=port, log_path=log_path, cwd=cwd)
+        finally:
+            await opencode_client.aclose()
+
+    return asyncio.run(run())
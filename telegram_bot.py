@@ -104,9 +104,9 @@ async def cmd_restart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
 
 async def cmd_opencode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    text = bot_core.handle_opencode_status()
+    text = await bot_core.handle_opencode_status()
     keyboard = None
-    if not bot_core.is_opencode_healthy():
+    if not await bot_core.is_opencode_healthy():
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("启动 OpenCode", callback_data=CALLBACK_START_OPENCODE)]
         ])
@@ -122,7 +122,7 @@ async def on_start_opencode(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     await q.answer()
     log_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "opencode.log")
-    ok, msg = bot_core.handle_start_opencode(log_path)
+    ok, msg = await bot_core.handle_start_opencode(log_path)
     await q.edit_message_text(f"OpenCode: {msg}")
 
 
@@ -153,7 +153,7 @@ def run_telegram(config: dict) -> None:
         return
     allowed_chat_ids = set(int(x) for x in config.get("allowed_chat_ids") or [])
     root = os.path.dirname(os.path.abspath(__file__))
-    ok, msg = runner.ensure_opencode_running(log_path=os.path.join(root, "opencode.log"))
+    ok, msg = runner.ensure_opencode_running_sync(log_path=os.path.join(root, "opencode.log"))
     logger.info("OpenCode: %s", msg)
     commands = [
         BotCommand("start", "欢迎与说明"),
@@ -168,8 +168,11 @@ def run_telegram(config: dict) -> None:
     async def post_init(application: Application) -> None:
         await application.bot.set_my_commands(commands)
 
+    async def post_shutdown(application: Application) -> None:
+        await bot_core.close()
+
     allow = AllowChatFilter()
-    app = Application.builder().token(token).post_init(post_init).build()
+    app = Application.builder().token(token).post_init(post_init).post_shutdown(post_shutdown).build()
     app.add_handler(CommandHandler("start", start, filters=allow))
     app.add_handler(CommandHandler("session", cmd_session, filters=allow))
     app.add_handler(CommandHandler("sessions", cmd_session, filters=allow))